@@ -1,10 +1,26 @@
 # Configuration and imports
 import os
-import json
-import pandas as pd
-from typing import Dict, List, Optional, Tuple
+import argparse
+import orjson
+import asyncio
+import hashlib
+import time
+import numpy as np
+import faiss
+import diskcache
+import zstandard
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple, Union
 from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+import openai
+import tiktoken
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import onnxruntime as ort
+from tokenizers import Tokenizer
 from datetime import datetime
 import logging
 
@@ -15,6 +31,138 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# On-disk cache of LLM outputs and semantic cache embeddings
+LLM_CACHE_PATH = ".llm_cache"
+
+class Category(IntEnum):
+    """Email categories, numbered so per-category data can be indexed directly."""
+    COMPLAINT = 0
+    INQUIRY = 1
+    FEEDBACK = 2
+    SUPPORT_REQUEST = 3
+    OTHER = 4
+
+    def __str__(self) -> str:
+        return self.name.lower()
+
+
+# Local int8 ONNX export of all-MiniLM-L6-v2 used for the semantic caches
+EMBEDDING_MODEL_DIR = os.path.join("models", "all-MiniLM-L6-v2-int8")
+
+# Define valid categories
+CATEGORY_BY_NAME = {str(category): category for category in Category}
+VALID_CATEGORIES = frozenset(CATEGORY_BY_NAME)
+
+# Instruction used by generate_response for each category
+CATEGORY_PROMPTS = {Category.COMPLAINT : "Write a polite mail for a customer complaint.",
+                    Category.INQUIRY : "write a polite mail for a customer inquiry. ",
+                    Category.FEEDBACK : "write a polite mail for a feedback.",
+                    Category.SUPPORT_REQUEST : "write a polite mail for a customer support request.",
+                    Category.OTHER: "Write a generic response for uncategorized emails."}
+
+RESPONSE_TEMPLATE = "{instruction}\nSubject : {subject}\nBody : {body}"
+
+# Model used by classify_email, supports automatic prompt caching
+CLASSIFICATION_MODEL = "gpt-4o-mini"
+
+# Static system prompt for classify_email, kept identical across calls so its prefix can be cached
+#Part 3
+#Few shot learning
+CLASSIFICATION_PROMPT = (
+    "Classify this email into one of the following categories. "
+    "Reply with a single letter: A=complaint B=inquiry C=feedback D=support_request E=other. "
+    "Focus on the primary intent of the email. If the email is not complaint, inquiry, feedback,support_request then classify it as other"
+    "Below are the few example: \n"
+    " - Subject: \"Intrested in partnership\" , Body: \"Hey I am intrested in partnership. SO  lets do it.\" --> E\n"
+    " - Subject: \"Need help in login\" , Body: \"I need your help in login into my account.\" --> D\n"
+)
+
+# System prompt for classifying and replying to an email in one call
+CLASSIFY_AND_RESPOND_PROMPT = (
+    "You handle incoming customer emails. Classify the email into one of the following categories: "
+    "complaint, inquiry, feedback, support_request, other. "
+    "Focus on the primary intent of the email. If the email is not complaint, inquiry, feedback, support_request then classify it as other.\n"
+    "Then write a reply that fits the category:\n"
+    " - complaint: a polite mail for a customer complaint\n"
+    " - inquiry: a polite mail for a customer inquiry\n"
+    " - feedback: a polite mail for a feedback\n"
+    " - support_request: a polite mail for a customer support request\n"
+    " - other: a generic response for uncategorized emails\n"
+    "Respond only with a JSON object of the form {\"category\": \"<category>\", \"reply\": \"<reply>\"}."
+)
+
+# Model used for generated responses
+RESPONSE_MODEL = "gpt-3.5-turbo"
+
+# Prompt for classify_batch, filled with the number of emails and the numbered emails
+CLASSIFY_BATCH_TEMPLATE = (
+    "Classify each email into one of the following categories: "
+    "complaint, inquiry, feedback, support_request, other. "
+    "Focus on the primary intent of the email. If the email is not complaint, inquiry, feedback, support_request then classify it as other. "
+    "Respond with {count} lines of 'ID: category'.\n\n"
+    "{emails}"
+)
+
+
+def _fingerprint(*parts: str) -> str:
+    """Short digest of the prompt and model, part of every cache key so prompt changes invalidate old entries."""
+    return hashlib.blake2b("\0".join(parts).encode(), digest_size=8).hexdigest()
+
+
+# Cache key prefixes, computed once per process
+CLASSIFY_KEY_PREFIX = "cls:" + _fingerprint(CLASSIFICATION_MODEL, CLASSIFICATION_PROMPT)
+#Separate from classify_email's entries since the batch uses another model and prompt
+CLASSIFY_BATCH_KEY_PREFIX = "batch:" + _fingerprint(RESPONSE_MODEL, CLASSIFY_BATCH_TEMPLATE)
+CLASSIFY_AND_RESPOND_KEY_PREFIX = "both:" + _fingerprint(RESPONSE_MODEL, CLASSIFY_AND_RESPOND_PROMPT)
+RESPONSE_KEY_PREFIXES = {
+    category: "resp:" + _fingerprint(RESPONSE_MODEL, RESPONSE_TEMPLATE, instruction)
+    for category, instruction in CATEGORY_PROMPTS.items()
+}
+
+
+def email_prompt(email: Dict) -> str:
+    """User message for an email; the instructions live in the static system prompts."""
+    #Joining a tuple of interned constants and the two fields is a single allocation
+    return "".join(("Subject: ", email["subject"], "\nBody: ", email["body"]))
+
+
+def fields_hash(subject: str, body: str) -> bytes:
+    """Hash of subject and body, each length-prefixed so no two different emails encode the same."""
+    h = hashlib.blake2b(digest_size=16)
+    for field in (subject, body):
+        data = field.encode()
+        h.update(len(data).to_bytes(4, "little"))
+        h.update(data)
+    return h.digest()
+
+
+def email_hash(email: Dict) -> bytes:
+    """Hash of subject + body, computed once per email and reused by every cache layer."""
+    return fields_hash(email["subject"], email["body"])
+
+
+@dataclass
+class EmailBatch:
+    """Emails stored column-wise, so each field can be processed as a single list."""
+    ids: List[str]
+    subjects: List[str]
+    bodies: List[str]
+    timestamps: List[Optional[str]]
+
+    @classmethod
+    def from_dicts(cls, emails: List[Dict]) -> "EmailBatch":
+        """Build a batch from email dicts like sample_emails. Only id, subject and body are required."""
+        return cls(
+            ids=[email["id"] for email in emails],
+            subjects=[email["subject"] for email in emails],
+            bodies=[email["body"] for email in emails],
+            timestamps=[email.get("timestamp") for email in emails],
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
 # Sample email dataset
 sample_emails = [
     {
@@ -55,21 +203,369 @@ sample_emails = [
 ]
 
 
+# HTTP/2 client shared by every EmailProcessor so connections are reused
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use or after it was closed."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            timeout=30.0,
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client and its pooled connections."""
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+class RateLimiter:
+    def __init__(self, rpm: int = 3500, tpm: int = 90000):
+        """
+        Token buckets for requests and tokens per minute.
+        Budget is reserved before a call is made so we stay under the limit instead of retrying 429s.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        """Top up both buckets at rpm/60 and tpm/60 per second."""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until one request and the given number of tokens are available, then take them."""
+        tokens = min(tokens, self.tpm)
+        #Waiters are served in order while holding the lock
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (tokens - self._tokens) * 60 / self.tpm,
+                ))
+
+
+_exponential_wait = wait_exponential(multiplier=1, min=1, max=30)
+
+
+def _wait_retry_after(retry_state) -> float:
+    """Use the Retry-After header of a failed call when present, exponential backoff otherwise."""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return _exponential_wait(retry_state)
+
+
+class SemanticCache:
+    def __init__(self, dim: int = 384, capacity: int = 1000, threshold: float = 0.87, k: int = 8):
+        """
+        Cache of labels keyed by normalized embeddings.
+        A lookup hits when the cosine similarity to a stored vector is >= threshold.
+        Once capacity is reached the least recently used entry is evicted.
+        Vectors live in an 8-bit scalar quantized HNSW index, searched for the k nearest entries.
+        """
+        self.dim = dim
+        self.capacity = capacity
+        self.threshold = threshold
+        self.k = k
+        #Live entries by id, least recently used first; evicted ids stay in the index until the next rebuild
+        self.labels: "OrderedDict[int, object]" = OrderedDict()
+        self._next_id = 0
+        self.index = self._new_index()
+
+    @property
+    def size(self) -> int:
+        return len(self.labels)
+
+    def _new_index(self):
+        """Create an empty inner-product HNSW index over 8-bit vectors."""
+        hnsw = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        #Components of unit vectors lie in [-1, 1], which is all the quantizer has to learn
+        hnsw.train(np.array([[-1.0] * self.dim, [1.0] * self.dim], dtype=np.float32))
+        hnsw.hnsw.efSearch = 64
+        #HNSW can't delete, the id map lets us skip and later drop evicted entries
+        return faiss.IndexIDMap2(hnsw)
+
+    def _rebuild(self):
+        """Rebuild the index with only the live entries."""
+        ids = np.fromiter(self.labels, dtype=np.int64, count=len(self.labels))
+        vectors = self.index.reconstruct_batch(ids)
+        self.index = self._new_index()
+        self.index.add_with_ids(vectors, ids)
+
+    def lookup(self, emb: Optional[np.ndarray]) -> Optional[object]:
+        """Return the label of the nearest stored vector, or None on a miss or without an embedding."""
+        if emb is None or not self.labels:
+            return None
+
+        #Embeddings are normalized so the inner product is the cosine similarity
+        #Quantized scoring happens inside faiss, the query is only viewed as a float32 row
+        query = np.ascontiguousarray(emb, dtype=np.float32).reshape(1, -1)
+        sims, ids = self.index.search(query, self.k)
+        for sim, i in zip(sims[0], ids[0]):
+            #Results are sorted, so nothing further can pass the threshold
+            if i < 0 or sim < self.threshold:
+                break
+            i = int(i)
+            if i in self.labels:
+                self.labels.move_to_end(i)
+                return self.labels[i]
+        return None
+
+    def add(self, emb: Optional[np.ndarray], label: object):
+        """Store a new embedding, evicting the oldest entry when full. Does nothing without an embedding."""
+        if emb is None:
+            return
+        if len(self.labels) >= self.capacity:
+            self.labels.popitem(last=False)
+
+        i = self._next_id
+        self._next_id += 1
+        self.index.add_with_ids(np.ascontiguousarray(emb, dtype=np.float32).reshape(1, -1), np.array([i], dtype=np.int64))
+        self.labels[i] = label
+
+        #Keep evicted entries from piling up in the graph
+        if self.index.ntotal >= 2 * self.capacity:
+            self._rebuild()
+
+    def dump(self) -> Tuple[bytes, List]:
+        """Return the stored vectors as float16 bytes and their labels, least recently used first."""
+        ids = np.fromiter(self.labels, dtype=np.int64, count=len(self.labels))
+        vectors = self.index.reconstruct_batch(ids) if len(ids) else np.zeros((0, self.dim))
+        return vectors.astype(np.float16).tobytes(), list(self.labels.values())
+
+    def restore(self, vectors: bytes, labels: List):
+        """Add entries previously returned by dump."""
+        V = np.frombuffer(vectors, dtype=np.float16).reshape(len(labels), self.dim)
+        for emb, label in zip(V.astype(np.float32), labels):
+            self.add(emb, label)
+
+
+def export_quantized_minilm(model_dir: str = EMBEDDING_MODEL_DIR):
+    """
+    Export all-MiniLM-L6-v2 to ONNX and quantize its weights to int8 (per channel).
+    One-off step, run with --export-embedding-model; requires requirements-export.txt.
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model_id = "sentence-transformers/all-MiniLM-L6-v2"
+    model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+    model.save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+
+    #Dynamic quantization targeting VNNI, writes model_quantized.onnx
+    quantizer = ORTQuantizer.from_pretrained(model)
+    config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=model_dir, quantization_config=config)
+
+
+class MiniLMEmbedder:
+    def __init__(self, model_dir: str = EMBEDDING_MODEL_DIR):
+        """Run the int8 MiniLM model locally with onnxruntime. The model has to be exported beforehand."""
+        model_path = os.path.join(model_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"{model_path} not found. Export it once with "
+                "`pip install -r requirements-export.txt` and "
+                "`python email_classifier_template.py --export-embedding-model`."
+            )
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=256)
+        self.tokenizer.enable_padding()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Return L2-normalized, mean-pooled embeddings for the texts, one row each."""
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, inputs)[0]
+
+        #Mean over the real (non padding) tokens
+        mask = attention_mask[..., None].astype(np.float32)
+        emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return (emb / np.linalg.norm(emb, axis=1, keepdims=True)).astype(np.float32)
+
+
 class EmailProcessor:
-    def __init__(self):
+    def __init__(self, max_concurrency: int = 5, rate_limiter: Optional[RateLimiter] = None):
         """Initialize the email processor with OpenAI API key."""
-        self.client = OpenAI(api_key= "OPENAI_API_KEY")
+        #Retries are handled by _chat so they respect the rate limiter
+        self.client = AsyncOpenAI(api_key= "OPENAI_API_KEY", max_retries= 0, http_client= get_http_client())
+
+        #Bounds the number of in-flight API requests
+        self._api_semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+        self.valid_categories = VALID_CATEGORIES
 
-        # Define valid categories
-        self.valid_categories = {
-            "complaint", "inquiry", "feedback",
-            "support_request", "other"
+        #classify_email answers with one letter per category
+        self._category_by_letter = {
+            "A": Category.COMPLAINT, "B": Category.INQUIRY, "C": Category.FEEDBACK,
+            "D": Category.SUPPORT_REQUEST, "E": Category.OTHER
         }
+        #Built on first use, tiktoken may have to download the encoding
+        self._letter_logit_bias: Optional[Dict[str, int]] = None
 
-    def classify_email(self, email: Dict) -> Optional[str]:
+        #Local embedding model used by the semantic caches, which are off without it
+        try:
+            self.embedder: Optional[MiniLMEmbedder] = MiniLMEmbedder()
+        except FileNotFoundError as e:
+            logger.warning("Semantic caches are disabled: %s", e)
+            self.embedder = None
+        if self.embedder is not None:
+            #First inference pays the graph setup, do it now rather than on the first email
+            self.embedder.encode(["warm up"])
+        self._last_embedding: Tuple[Optional[bytes], Optional[np.ndarray]] = (None, None)
+
+        #Near duplicate emails reuse the earlier classification / response
+        self.classification_cache = SemanticCache()
+        #Indexed by Category
+        self.response_caches = tuple(SemanticCache() for _ in Category)
+
+        #Exact prompt cache, persisted so repeated runs don't hit the API again
+        self._llm_cache = diskcache.Cache(LLM_CACHE_PATH)
+        self._compressor = zstandard.ZstdCompressor()
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._load_semantic_caches()
+
+    def close(self):
+        """Persist the semantic caches and close the on-disk cache. The shared HTTP client stays open."""
+        try:
+            self._save_semantic_caches()
+        finally:
+            self._llm_cache.close()
+
+    def _cache_get_bytes(self, key: str) -> Optional[bytes]:
+        """Read zstd-compressed bytes from the on-disk cache."""
+        value = self._llm_cache.get(key)
+        if value is None:
+            return None
+        return self._decompressor.decompress(value)
+
+    def _cache_set_bytes(self, key: str, value: bytes):
+        """Write bytes to the on-disk cache, zstd-compressed."""
+        self._llm_cache.set(key, self._compressor.compress(value))
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Read a zstd-compressed string from the on-disk cache."""
+        value = self._cache_get_bytes(key)
+        return None if value is None else value.decode()
+
+    def _cache_set(self, key: str, value: str):
+        """Write a string to the on-disk cache, zstd-compressed."""
+        self._cache_set_bytes(key, value.encode())
+
+    def _load_semantic_caches(self):
+        """Refill the semantic caches from the last run."""
+        state = self._llm_cache.get("semantic:classification")
+        if state is not None:
+            vectors, names = state
+            self.classification_cache.restore(vectors, [CATEGORY_BY_NAME[name] for name in names])
+        for category in Category:
+            state = self._llm_cache.get(f"semantic:response:{category}")
+            if state is not None:
+                self.response_caches[category].restore(*state)
+
+    def _save_semantic_caches(self):
+        """Store the semantic caches as float16 embeddings so the next run can reuse them."""
+        vectors, labels = self.classification_cache.dump()
+        self._llm_cache.set("semantic:classification", (vectors, [str(label) for label in labels]))
+        for category in Category:
+            self._llm_cache.set(f"semantic:response:{category}", self.response_caches[category].dump())
+
+    @retry(
+        retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+        wait=_wait_retry_after,
+        stop=stop_after_attempt(5),
+        reraise=True,
+    )
+    async def _chat(self, messages: List[Dict], max_tokens: int, model: str = RESPONSE_MODEL, **kwargs):
+        """Make a chat completion call within the rate limit and concurrency budget."""
+        #Rough estimate: ~4 characters per token plus the completion budget
+        est_tokens = sum(len(m["content"]) for m in messages) // 4 + max_tokens
+        await self.rate_limiter.acquire(tokens=est_tokens)
+        async with self._api_semaphore:
+            return await self.client.chat.completions.create(
+                model= model,
+                messages= messages,
+                max_tokens= max_tokens,
+                **kwargs,
+            )
+
+    def _get_letter_logit_bias(self) -> Dict[str, int]:
+        """Logit bias that only lets the letter tokens be sampled, empty if the encoding can't be loaded."""
+        if self._letter_logit_bias is None:
+            try:
+                encoding = tiktoken.encoding_for_model(CLASSIFICATION_MODEL)
+                #Letters with and without a leading space
+                self._letter_logit_bias = {
+                    str(token): 100
+                    for letter in self._category_by_letter
+                    for token in encoding.encode(letter) + encoding.encode(" " + letter)
+                }
+            except Exception as e:
+                logger.warning("Letter logit bias is disabled: %s", e)
+                self._letter_logit_bias = {}
+        return self._letter_logit_bias
+
+    def _embed(self, email: Dict, _hash: bytes) -> Optional[np.ndarray]:
+        """Embed subject + body, reusing the result for consecutive calls on the same email. None without a model."""
+        if self.embedder is None:
+            return None
+        if self._last_embedding[0] != _hash:
+            emb = self.embedder.encode([email["subject"] + "\n" + email["body"]])[0]
+            self._last_embedding = (_hash, emb)
+        return self._last_embedding[1]
+
+    def embed_batch(self, batch: EmailBatch) -> Union[np.ndarray, List[None]]:
+        """Embed every email of the batch in one forward pass, one row per email (all None without a model)."""
+        if self.embedder is None:
+            return [None] * len(batch)
+        texts = [f"{subject}\n{body}" for subject, body in zip(batch.subjects, batch.bodies)]
+        return self.embedder.encode(texts)
+
+    async def classify_email(self, email: Dict, _hash: Optional[bytes] = None,
+                             embedding: Optional[np.ndarray] = None) -> Optional[Category]:
         """
         Classify an email using LLM.
         Returns the classification category or None if classification fails.
+        _hash is the email_hash of the email, computed here if not given.
+        embedding is the email's row from embed_batch, computed here if not given.
         
         TODO: 
         1. Design and implement the classification prompt
@@ -77,44 +573,174 @@ class EmailProcessor:
         3. Validate and return the classification
         """
         try:
-            #Part 3
-            #Few shot learning
-            prompt = ("Classify this email into one of the following categories: "
-            "complaint, inquiry, feedback,support_request, other."
-            "Focus on the primary intent of the email. If the email is not complaint, inquiry, feedback,support_request then classify it as other"
-            "Below are the few example: \n"
-            " - Subject: \"Intrested in partnership\" , Body: \"Hey I am intrested in partnership. SO  lets do it.\" --> other\n"
-            " - Subject: \"Need help in login\" , Body: \"I need your help in login into my account.\" --> support_request\n\n"
-            f"Subject: {email["subject"]}\n"
-            f"Body: {email["body"]}"
+            _hash = _hash or email_hash(email)
+
+            #Same prompt as an earlier run, no need to ask GPT again
+            key = CLASSIFY_KEY_PREFIX + _hash.hex()
+            cached = self._cache_get(key)
+            if cached is not None:
+                logger.info("Email %s is classified as %s (exact cache)", email['id'], cached)
+                return CATEGORY_BY_NAME[cached]
+
+            #Skip the API call for emails close to one seen before
+            emb = embedding if embedding is not None else self._embed(email, _hash)
+            cached = self.classification_cache.lookup(emb)
+            if cached is not None:
+                logger.info("Email %s is classified as %s (semantic cache)", email['id'], cached)
+                return cached
             
-            )
-            
-            #Call Chatgpt API
-            response = self.client.chat.completions.create(
-                model= "gpt-3.5-turbo", #Model name
-                messages= [{"role": "user" , "content": prompt}] ,
-                temperature= 0.3, #not get too much randomness
-                max_tokens= 10, #Number of max token GPT will produce
+            #Only the email itself changes between calls
+            user_prompt = email_prompt(email)
+
+            #Call Chatgpt API, constrained to a single category letter
+            response = await self._chat(
+                model= CLASSIFICATION_MODEL,
+                messages= [{"role": "system", "content": CLASSIFICATION_PROMPT},
+                           {"role": "user" , "content": user_prompt}],
+                temperature= 0, #always the most likely letter
+                max_tokens= 1, #One letter token is the whole answer
+                logit_bias= self._get_letter_logit_bias() or openai.NOT_GIVEN,
             )
 
             #using the response to get out classification
-            classification = response.choices[0].message.content.strip().lower()
-
-            if classification in self.valid_categories:
-                logger.info(f"Email {email["id"]} is caassified as {classification}")
-                return classification
-            else:
-                logger.warning("No category was found")
-                return None
+            classification = self._category_by_letter[response.choices[0].message.content.strip()]
+            logger.info("Email %s is classified as %s", email['id'], classification)
+            self.classification_cache.add(emb, classification)
+            self._cache_set(key, str(classification))
+            return classification
         except Exception as e:
             logger.error("GPT did not classify the Email")
             return None
         
 
-    def generate_response(self, email: Dict, classification: str) -> Optional[str]:
+    async def classify_batch(self, batch: Union[EmailBatch, List[Dict]]) -> List[Optional[Category]]:
+        """
+        Classify several emails with a single LLM call.
+        Takes an EmailBatch, or a list of email dicts which is converted to one.
+        Emails already in the exact or semantic cache are answered from it and left out of the call.
+        The exact cache keeps batch results apart from classify_email's, the semantic cache is shared.
+        Returns one category per email, None where the model gave no valid category.
+        """
+        classifications: List[Optional[Category]] = [None] * len(batch)
+        if not len(batch):
+            return classifications
+
+        try:
+            if not isinstance(batch, EmailBatch):
+                batch = EmailBatch.from_dicts(batch)
+            embeddings = self.embed_batch(batch)
+
+            #Positions in the batch that still need GPT
+            keys = [CLASSIFY_BATCH_KEY_PREFIX + fields_hash(subject, body).hex()
+                    for subject, body in zip(batch.subjects, batch.bodies)]
+            pending = []
+            for position, emb in enumerate(embeddings):
+                cached = self._cache_get(keys[position])
+                if cached is not None:
+                    classifications[position] = CATEGORY_BY_NAME[cached]
+                else:
+                    classifications[position] = self.classification_cache.lookup(emb)
+                if classifications[position] is None:
+                    pending.append(position)
+
+            if pending:
+                numbered = "\n".join(
+                    "".join((str(i), ". Subject: ", batch.subjects[position], " Body: ", batch.bodies[position]))
+                    for i, position in enumerate(pending, start=1)
+                )
+                prompt = CLASSIFY_BATCH_TEMPLATE.format(count=len(pending), emails=numbered)
+
+                #One round-trip for the whole batch
+                response = await self._chat(
+                    messages= [{"role": "user" , "content": prompt}] ,
+                    temperature= 0.3, #not get too much randomness
+                    max_tokens= 10 * len(pending), #Enough for one short line per email
+                )
+
+                #Lines look like "3: feedback"
+                for line in response.choices[0].message.content.splitlines():
+                    index, sep, category = line.partition(":")
+                    if not sep or not index.strip().isdigit():
+                        continue
+                    i = int(index.strip()) - 1
+                    category = CATEGORY_BY_NAME.get(category.strip().lower())
+                    if 0 <= i < len(pending) and category is not None:
+                        position = pending[i]
+                        classifications[position] = category
+                        self.classification_cache.add(embeddings[position], category)
+                        self._cache_set(keys[position], str(category))
+
+            for email_id, classification in zip(batch.ids, classifications):
+                if classification is None:
+                    logger.warning("No category was found for email %s", email_id)
+                else:
+                    logger.info("Email %s is classified as %s (batch)", email_id, classification)
+        except Exception as e:
+            logger.error("GPT did not classify the Email batch")
+
+        return classifications
+
+    async def classify_and_respond(self, email: Dict, _hash: Optional[bytes] = None,
+                                   embedding: Optional[np.ndarray] = None) -> Optional[Tuple[Category, str]]:
+        """
+        Classify an email and generate its response with a single LLM call.
+        Returns (classification, response) or None if either part fails.
+        _hash is the email_hash of the email, computed here if not given.
+        embedding is the email's row from embed_batch, computed here if not given.
+        """
+        try:
+            _hash = _hash or email_hash(email)
+
+            key = CLASSIFY_AND_RESPOND_KEY_PREFIX + _hash.hex()
+            cached = self._cache_get_bytes(key)
+            if cached is not None:
+                logger.info("Email %s is classified and responded from the exact cache", email['id'])
+                name, generated_response = orjson.loads(cached)
+                return CATEGORY_BY_NAME[name], generated_response
+
+            #Both the category and the reply have to be known for a semantic hit
+            emb = embedding if embedding is not None else self._embed(email, _hash)
+            classification = self.classification_cache.lookup(emb)
+            if classification is not None:
+                cached = self.response_caches[classification].lookup(emb)
+                if cached is not None:
+                    logger.info("Email %s is classified as %s and responded from the semantic cache", email['id'], classification)
+                    return classification, cached
+
+            user_prompt = email_prompt(email)
+            response = await self._chat(
+                messages= [{"role": "system", "content": CLASSIFY_AND_RESPOND_PROMPT},
+                           {"role": "user", "content": user_prompt}],
+                temperature= 0.4, #not get too much randomness
+                max_tokens= 150, #Short category plus the reply
+                response_format= {"type": "json_object"},
+            )
+
+            #orjson parses str input directly, no extra encode needed
+            result = orjson.loads(response.choices[0].message.content)
+            classification = CATEGORY_BY_NAME.get(str(result.get("category", "")).strip().lower())
+            generated_response = str(result.get("reply", "")).strip()
+
+            if classification is None or not generated_response:
+                logger.warning("No valid category or reply was found for email %s", email['id'])
+                return None
+
+            logger.info("Email %s is classified as %s and responded by GPT", email['id'], classification)
+            self.classification_cache.add(emb, classification)
+            self.response_caches[classification].add(emb, generated_response)
+            self._cache_set_bytes(key, orjson.dumps([str(classification), generated_response]))
+            return classification, generated_response
+
+        except Exception as e:
+            logger.error("GPT did not classify and respond to the Email")
+            return None
+
+    async def generate_response(self, email: Dict, classification: Category, _hash: Optional[bytes] = None,
+                                embedding: Optional[np.ndarray] = None) -> Optional[str]:
         """
         Generate an automated response based on email classification.
+        _hash is the email_hash of the email, computed here if not given.
+        embedding is the email's row from embed_batch, computed here if not given.
         
         TODO:
         1. Design the response generation prompt
@@ -122,29 +748,37 @@ class EmailProcessor:
         3. Add error handling
         """
         try:
-            
-
-            every_category = {"complaint" : "Write a polite mail for a customer complaint.",
-                             "inquiry" : "write a polite mail for a customer inquiry. ", 
-                             "feedback" : "write a polite mail for a feedback.",
-                             "support_request" : "write a polite mail for a customer support request.", 
-                             "other": "Write a generic response for uncategorized emails."}
-            prompt = (f"{every_category[classification]}\n"
-                      f"Subject : {email["subject"]}\n"
-                      f"Body : {email["body"]}"
+            _hash = _hash or email_hash(email)
+
+            key = RESPONSE_KEY_PREFIXES[classification] + _hash.hex()
+            cached = self._cache_get(key)
+            if cached is not None:
+                logger.info("Email %s is responded from the exact cache", email['id'])
+                return cached
+
+            emb = embedding if embedding is not None else self._embed(email, _hash)
+            cached = self.response_caches[classification].lookup(emb)
+            if cached is not None:
+                logger.info("Email %s is responded from the semantic cache", email['id'])
+                return cached
+
+            prompt = RESPONSE_TEMPLATE.format(
+                instruction=CATEGORY_PROMPTS[classification],
+                subject=email["subject"],
+                body=email["body"],
             )
 
             #Call Chatgpt API for getting the response
-            response = self.client.chat.completions.create(
-                model= "gpt-3.5-turbo", #Model name
+            response = await self._chat(
                 messages= [{"role": "user" , "content": prompt}] ,
                 temperature= 0.4, #not get too much randomness
                 max_tokens= 100, #Number of max token GPT will produce
             )
 
             generated_response = response.choices[0].message.content.strip()
-            logger.info(f"Email {email["id"]} is responded by GPT and the response is {generated_response}")
-
+            logger.info("Email %s is responded by GPT and the response is %s", email['id'], generated_response)
+            self.response_caches[classification].add(emb, generated_response)
+            self._cache_set(key, generated_response)
 
             return generated_response
 
@@ -158,19 +792,24 @@ class EmailAutomationSystem:
     def __init__(self, processor: EmailProcessor):
         """Initialize the automation system with an EmailProcessor."""
         self.processor = processor
-        self.response_handlers = {
-            "complaint": self._handle_complaint,
-            "inquiry": self._handle_inquiry,
-            "feedback": self._handle_feedback,
-            "support_request": self._handle_support_request,
-            "other": self._handle_other
-        }
-
-    def process_email(self, email: Dict) -> Dict:
+        #Indexed by Category
+        self.response_handlers = (
+            self._handle_complaint,
+            self._handle_inquiry,
+            self._handle_feedback,
+            self._handle_support_request,
+            self._handle_other
+        )
+
+    async def process_email(self, email: Dict, classification: Optional[Category] = None,
+                            embedding: Optional[np.ndarray] = None) -> Dict:
 
         """
         Process a single email through the complete pipeline.
         Returns a dictionary with the processing results.
+        Without a classification, the email is classified and responded with one LLM call.
+        A classification from classify_batch can be passed in to only generate the response.
+        An embedding from EmailProcessor.embed_batch saves embedding the email again.
         
         TODO:
         1. Implement the complete processing pipeline
@@ -185,127 +824,158 @@ class EmailAutomationSystem:
 
             if email_id is None:
                 raise ValueError(f"Email id Not Found")
+            logger.info("\nProcessing email %s...", email_id)
+
+            #Hashed once, shared by every cache lookup below
+            _hash = email_hash(email)
             
-            #To get the classification of a specific email
-            classification = self.processor.classify_email(email)
             if classification is None:
-                raise ValueError(f"The GPT model did not classify the specific email")
-            
-            #Generate Response usong the GPT;s API
-            response =  self.processor.generate_response(email, classification)
+                #Classify and generate the response in a single GPT call
+                outcome = await self.processor.classify_and_respond(email, _hash=_hash, embedding=embedding)
+                if outcome is None:
+                    raise ValueError(f"The GPT model did not classify the specific email")
+                classification, response = outcome
+            else:
+                #Generate Response usong the GPT;s API
+                response = await self.processor.generate_response(email, classification, _hash=_hash, embedding=embedding)
             
             if response is None:
                 raise ValueError(f"The GPT model did not response the specific email")
             
             # Handle the response based on the classification
 
-            handler = self.response_handlers.get(classification)
-            if handler:
-                handler(email, response)
-                result["response_sent"] = True
-            else:
-                raise ValueError(f"No handler was found")
+            await self.response_handlers[classification](email, response)
+            result["response_sent"] = True
             
             result["email_id"] = email_id
-            result["classification"] = classification
+            result["classification"] = str(classification)
             result["success"] = True
 
 
         except Exception as e:
-            logger.error(f"Email {email_id} did not processes properly")
+            logger.error("Email %s did not processes properly", email_id)
 
         return result
 
-    def _handle_complaint(self, email: Dict , response: str):
+    async def _handle_complaint(self, email: Dict , response: str):
         """
         Handle complaint emails.
         TODO: Implement complaint handling logic
         """
-        send_complaint_response(email["id"] , response)
-        create_urgent_ticket(email["id"] , "complaint" , f"Subject: {email["subject"]}")
+        #Reply and ticket are independent, send both at once
+        await asyncio.gather(
+            send_complaint_response(email["id"] , response),
+            create_urgent_ticket(email["id"] , "complaint" , f"Subject: {email['subject']}"),
+        )
 
-    def _handle_inquiry(self, email: Dict, response: str):
+    async def _handle_inquiry(self, email: Dict, response: str):
         """
         Handle inquiry emails.
         TODO: Implement inquiry handling logic
         """
-        send_standard_response(email["id"], response)
+        await send_standard_response(email["id"], response)
 
-    def _handle_feedback(self, email: Dict,  response: str):
+    async def _handle_feedback(self, email: Dict,  response: str):
         """
         Handle feedback emails.
         TODO: Implement feedback handling logic
         """
-        send_standard_response(email["id"], response)
+        await send_standard_response(email["id"], response)
 
-    def _handle_support_request(self, email: Dict, response: str):
+    async def _handle_support_request(self, email: Dict, response: str):
         """
         Handle support request emails.
         TODO: Implement support request handling logic
         """
-        send_standard_response(email["id"], response)
-        create_support_ticket(email["id"], f"Subject: {email["subject"]}")
+        await asyncio.gather(
+            send_standard_response(email["id"], response),
+            create_support_ticket(email["id"], f"Subject: {email['subject']}"),
+        )
 
 
-    def _handle_other(self, email: Dict, response: str):
+    async def _handle_other(self, email: Dict, response: str):
         """
         Handle other category emails.
         TODO: Implement handling logic for other categories
         """
-        send_standard_response(email["id"], response)
+        await send_standard_response(email["id"], response)
 
-# Mock service functions
-def send_complaint_response(email_id: str, response: str):
+# Mock service functions, async so they can be swapped for real async email / ticket clients
+async def send_complaint_response(email_id: str, response: str):
     """Mock function to simulate sending a response to a complaint"""
-    logger.info(f"Sending complaint response for email {email_id}")
+    logger.info("Sending complaint response for email %s", email_id)
     # In real implementation: integrate with email service
 
 
-def send_standard_response(email_id: str, response: str):
+async def send_standard_response(email_id: str, response: str):
     """Mock function to simulate sending a standard response"""
-    logger.info(f"Sending standard response for email {email_id}")
+    logger.info("Sending standard response for email %s", email_id)
     # In real implementation: integrate with email service
 
 
-def create_urgent_ticket(email_id: str, category: str, context: str):
+async def create_urgent_ticket(email_id: str, category: str, context: str):
     """Mock function to simulate creating an urgent ticket"""
-    logger.info(f"Creating urgent ticket for email {email_id}")
+    logger.info("Creating urgent ticket for email %s", email_id)
     # In real implementation: integrate with ticket system
 
 
-def create_support_ticket(email_id: str, context: str):
+async def create_support_ticket(email_id: str, context: str):
     """Mock function to simulate creating a support ticket"""
-    logger.info(f"Creating support ticket for email {email_id}")
+    logger.info("Creating support ticket for email %s", email_id)
     # In real implementation: integrate with ticket system
 
 
-def log_customer_feedback(email_id: str, feedback: str):
+async def log_customer_feedback(email_id: str, feedback: str):
     """Mock function to simulate logging customer feedback"""
-    logger.info(f"Logging feedback for email {email_id}")
+    logger.info("Logging feedback for email %s", email_id)
     # In real implementation: integrate with feedback system
 
 
-def run_demonstration():
-    """Run a demonstration of the complete system."""
+async def run_demonstration(as_dataframe: bool = False):
+    """
+    Run a demonstration of the complete system.
+    Returns the list of results, or a pandas DataFrame if as_dataframe is True.
+    """
     # Initialize the system
     processor = EmailProcessor()
     automation_system = EmailAutomationSystem(processor)
 
-    # Process all sample emails
-    results = []
-    for email in sample_emails:
-        logger.info(f"\nProcessing email {email['id']}...")
-        result = automation_system.process_email(email)
-        results.append(result)
-
-    # Create a summary DataFrame
-    df = pd.DataFrame(results)
+    try:
+        # Embed all sample emails in one forward pass
+        embeddings = processor.embed_batch(EmailBatch.from_dicts(sample_emails))
+
+        # Process all sample emails concurrently, one GPT call per email
+        results = await asyncio.gather(*(
+            automation_system.process_email(email, embedding=embedding)
+            for email, embedding in zip(sample_emails, embeddings)
+        ))
+    finally:
+        #Keep the semantic caches and close the stores even if the run is interrupted
+        processor.close()
+        await close_http_client()
+
+    # Print a summary table
     print("\nProcessing Summary:")
-    print(df[["email_id", "success", "classification", "response_sent"]])
+    print(f"{'email_id':<10}{'success':<10}{'classification':<20}{'response_sent':<15}")
+    for result in results:
+        print(f"{str(result['email_id']):<10}{str(result['success']):<10}"
+              f"{str(result['classification']):<20}{str(result['response_sent']):<15}")
 
-    return df
+    if as_dataframe:
+        #pandas is only imported when a DataFrame is actually wanted
+        import pandas as pd
+        return pd.DataFrame(results)
+    return results
 
 
 # Example usage:
 if __name__ == "__main__":
-    results_df = run_demonstration()
+    parser = argparse.ArgumentParser(description="Email classification demo")
+    parser.add_argument("--export-embedding-model", action="store_true",
+                        help=f"export the int8 MiniLM model to {EMBEDDING_MODEL_DIR} and exit")
+    args = parser.parse_args()
+
+    if args.export_embedding_model:
+        export_quantized_minilm()
+    else:
+        results = asyncio.run(run_demonstration())